@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""Benchmarks for theme-switcher.
+
+``micro`` times the file handling functions against generated config files,
+and ``e2e`` measures the latency from a ``SettingChanged`` signal to the end
+of the switch, with the real daemon running on a private session bus against
+a stand-in settings portal. Results are written as JSON so that they can be
+compared across releases.
+
+``imports`` measures how long importing ``theme-switcher.py`` takes in fresh
+interpreters and fails if it exceeds a budget or if it imports any of the
+modules that must only be imported when needed.
+
+Examples::
+
+    benchmarks/bench.py micro --output micro.json
+    benchmarks/bench.py e2e --switches 200 --output e2e.json
+    benchmarks/bench.py imports --budget-ms 150
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "theme-switcher.py")
+
+DELIMITERS = {
+    "begin": "<<< theme-switcher <<<",
+    "separator": "=====",
+    "end": ">>> theme-switcher >>>",
+}
+
+
+def load_theme_switcher():
+    """Imports ``theme-switcher.py`` as a module."""
+    spec = importlib.util.spec_from_file_location("theme_switcher", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def summarize(samples: list[float]) -> dict:
+    """Returns summary statistics of durations in seconds."""
+    samples = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, round(p / 100 * (len(samples) - 1)))]
+
+    return {
+        "runs": len(samples),
+        "min": samples[0],
+        "mean": statistics.fmean(samples),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": samples[-1],
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    """Calls ``fn`` ``repeat`` times and summarizes the durations."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def generate_config_file(path: str, lines: int, blocks: int,
+                         block_lines: int = 10):
+    """Writes a config file with managed blocks spread evenly over it.
+
+    Args:
+        path: The path of the file.
+        lines: The approximate total number of lines.
+        blocks: The number of managed blocks.
+        block_lines: The number of lines of each theme in a block.
+    """
+    filler = max(0, lines - blocks * (2 * block_lines + 3)) // (blocks + 1)
+    with open(path, "w") as f:
+        for b in range(blocks + 1):
+            for i in range(filler):
+                f.write(f"option_{b}_{i} value  # comment #{i:06x}\n")
+            if b == blocks:
+                break
+            f.write(f"# {DELIMITERS['begin']}\n")
+            for i in range(block_lines):
+                f.write(f"color{i} #ffffff\n")
+            f.write(f"# {DELIMITERS['separator']}\n")
+            for i in range(block_lines):
+                f.write(f"# color{i} #000000\n")
+            f.write(f"# {DELIMITERS['end']}\n")
+
+
+def legacy_scan_sections(lines: list[str], delimiters, comment_token: str) -> int:
+    """The delimiter matching of ``scan_sections`` before ``LineMatcher``.
+
+    It removes the comment token everywhere in every line. It only counts
+    the delimiter lines, so it does slightly less work than ``scan_sections``.
+    """
+    count = 0
+    for line in lines:
+        cleaned_line = line.replace(comment_token, "").strip()
+        if cleaned_line == delimiters.begin or \
+                cleaned_line.startswith(delimiters.separator) or \
+                cleaned_line == delimiters.end:
+            count += 1
+    return count
+
+
+def config_dict(files: int, commands: int, settings: int) -> dict:
+    """Returns a configuration dictionary with the given number of entries."""
+    return {
+        "delimiters": DELIMITERS,
+        "commands": {
+            "dark_to_light": [f"true {i}" for i in range(commands)],
+            "light_to_dark": [f"true {i}" for i in range(commands)],
+        },
+        "config_files": [
+            {"name": f"app{i}", "path": f"$XDG_CONFIG_HOME/app{i}/config",
+             "comment_token": "#"}
+            for i in range(files)
+        ],
+        "extensions": [{
+            "name": "extension",
+            "settings": [{"path": f"key{i}", "light": "false", "dark": "true"}
+                         for i in range(settings)],
+        }],
+    }
+
+
+def micro(args) -> list[dict]:
+    ts = load_theme_switcher()
+    results = []
+
+    line = "background #ffffff\n"
+    commented = "# background #ffffff\n"
+    for name, fn in (("comment", lambda: ts.comment(line, "#")),
+                     ("uncomment", lambda: ts.uncomment(commented, "#"))):
+        n = 100_000
+        result = measure(lambda: [fn() for _ in range(n)], args.repeat)
+        results.append({"benchmark": name, "params": {"calls": n}, **result})
+
+    for entries in (10, 100, 1000):
+        data = config_dict(entries, entries, entries)
+        results.append({"benchmark": "Config.from_dict",
+                        "params": {"entries": entries},
+                        **measure(lambda: ts.Config.from_dict(data), args.repeat)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for lines in args.lines:
+            for blocks in args.blocks:
+                path = os.path.join(tmp, f"{lines}-{blocks}.conf")
+                generate_config_file(path, lines, blocks)
+                data = config_dict(0, 0, 0)
+                data["config_files"] = [
+                    {"name": "bench", "path": path, "comment_token": "#"}]
+                config = ts.Config.from_dict(data)
+                app = config.config_files[0]
+                modes = [ts.theme.dark, ts.theme.light]
+                params = {"lines": lines, "blocks": blocks,
+                          "bytes": os.path.getsize(path)}
+
+                with open(path) as f:
+                    file_lines = f.readlines()
+                for matcher, scan in (
+                        ("legacy", lambda: legacy_scan_sections(
+                            file_lines, config.delimiters, "#")),
+                        ("LineMatcher", lambda: ts.scan_sections(
+                            file_lines, app.matcher))):
+                    results.append({
+                        "benchmark": "scan_sections",
+                        "params": {**params, "matcher": matcher},
+                        **measure(scan, args.repeat),
+                    })
+                del file_lines
+
+                def switch(cold: bool):
+                    if cold:
+                        ts._section_index.clear()
+                        ts._span_index.clear()
+                    modes.reverse()
+                    ts.modify_config_file(config, app, modes[0])
+
+                # Compare reading all lines with the mmap scanner, whatever
+                # the size of the file.
+                streaming_size = ts.STREAMING_SIZE
+                for scanner, ts.STREAMING_SIZE in (("lines", sys.maxsize),
+                                                   ("mmap", 0)):
+                    for cold in (True, False):
+                        results.append({
+                            "benchmark": "modify_config_file",
+                            "params": {**params, "scanner": scanner,
+                                       "index": "cold" if cold else "warm"},
+                            **measure(lambda: switch(cold), args.repeat),
+                        })
+                    results.append({
+                        "benchmark": "modify_config_file",
+                        "params": {**params, "scanner": scanner,
+                                   "index": "unchanged"},
+                        **measure(lambda: ts.modify_config_file(
+                            config, app, modes[0]), args.repeat),
+                    })
+                ts.STREAMING_SIZE = streaming_size
+                os.unlink(path)
+                print(f"micro: {lines} lines, {blocks} blocks", file=sys.stderr)
+    return results
+
+
+PORTAL_NAME = "org.freedesktop.portal.Desktop"
+PORTAL_PATH = "/org/freedesktop/portal/desktop"
+SETTINGS_INTERFACE = "org.freedesktop.portal.Settings"
+
+
+def e2e(args) -> list[dict]:
+    import dbus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+    from gi.repository import GLib
+
+    class Portal(dbus.service.Object):
+        """A stand-in for the settings interface of the desktop portal."""
+        def __init__(self, bus):
+            self.value = dbus.UInt32(0)
+            super().__init__(dbus.service.BusName(PORTAL_NAME, bus), PORTAL_PATH)
+
+        @dbus.service.method(SETTINGS_INTERFACE, in_signature="ss",
+                             out_signature="v")
+        def ReadOne(self, namespace, key):
+            return self.value
+
+        @dbus.service.method(SETTINGS_INTERFACE, in_signature="ss",
+                             out_signature="v")
+        def Read(self, namespace, key):
+            return dbus.types.Variant(self.value, variant_level=1)
+
+        @dbus.service.signal(SETTINGS_INTERFACE, signature="ssv")
+        def SettingChanged(self, namespace, key, value):
+            pass
+
+        def change(self, value: int):
+            self.value = dbus.UInt32(value)
+            self.SettingChanged("org.freedesktop.appearance", "color-scheme",
+                                self.value)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bus_daemon = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+            stdout=subprocess.PIPE, text=True)
+        address = bus_daemon.stdout.readline().strip()
+        env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address,
+                   XDG_CONFIG_HOME=os.path.join(tmp, "config"),
+                   XDG_STATE_HOME=os.path.join(tmp, "state"),
+                   XDG_RUNTIME_DIR=tmp)
+
+        config_dir = os.path.join(tmp, "config", "theme-switcher")
+        os.makedirs(config_dir)
+        data = config_dict(0, args.commands, 0)
+        data["debounce_ms"] = 0
+        for i in range(args.files):
+            path = os.path.join(tmp, f"app{i}.conf")
+            generate_config_file(path, args.file_lines, 1)
+            data["config_files"].append(
+                {"name": f"app{i}", "path": path, "comment_token": "#"})
+        with open(os.path.join(config_dir, "config.yaml"), "w") as f:
+            json.dump(data, f)
+
+        threads_init()
+        DBusGMainLoop(set_as_default=True)
+        portal = Portal(dbus.bus.BusConnection(address))
+        loop = GLib.MainLoop()
+        threading.Thread(target=loop.run, daemon=True).start()
+
+        switched = threading.Condition()
+        done: list[float] = []
+
+        def follow(stream):
+            for line in stream:
+                if "switched to" in line:
+                    with switched:
+                        done.append(time.perf_counter())
+                        switched.notify()
+
+        daemon = subprocess.Popen([sys.executable, SCRIPT], env=env,
+                                  stderr=subprocess.PIPE, text=True)
+        threading.Thread(target=follow, args=(daemon.stderr,),
+                         daemon=True).start()
+        try:
+            # The daemon syncs to the light theme of the portal on start.
+            with switched:
+                if not switched.wait_for(lambda: done, timeout=30):
+                    raise RuntimeError("the daemon did not start")
+            samples = []
+            for i in range(args.switches):
+                with switched:
+                    count = len(done)
+                    start = time.perf_counter()
+                    GLib.idle_add(portal.change, 1 - i % 2)
+                    if not switched.wait_for(lambda: len(done) > count,
+                                             timeout=30):
+                        raise RuntimeError("the switch did not finish")
+                    samples.append(done[-1] - start)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            loop.quit()
+            bus_daemon.terminate()
+            bus_daemon.wait()
+
+    return [{"benchmark": "signal-to-done",
+             "params": {"files": args.files, "file_lines": args.file_lines,
+                        "commands": args.commands},
+             **summarize(samples)}]
+
+
+LAZY_MODULES = ("dbus", "gi", "yaml")
+
+IMPORT_CODE = f"""
+import importlib.util, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("theme_switcher", {SCRIPT!r})
+module = sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+"""
+
+
+def imports(args) -> list[dict]:
+    samples = []
+    loaded: set[str] = set()
+    for _ in range(args.repeat):
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                                  IMPORT_CODE], capture_output=True, text=True,
+                                 check=True)
+        samples.append(float(process.stdout))
+        for line in process.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                loaded.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+
+    result = {"benchmark": "import", "params": {"budget_ms": args.budget_ms},
+              **summarize(samples),
+              "lazy_modules_loaded": sorted(loaded & set(LAZY_MODULES))}
+    if result["lazy_modules_loaded"]:
+        print(f"imports: {', '.join(result['lazy_modules_loaded'])} imported "
+              f"at module load", file=sys.stderr)
+        args.failed = True
+    if result["p50"] * 1000 > args.budget_ms:
+        print(f"imports: {result['p50'] * 1000:.1f} ms exceeds the budget of "
+              f"{args.budget_ms} ms", file=sys.stderr)
+        args.failed = True
+    return [result]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    # Given to each suite, so that it can follow the suite name.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="the JSON file to write "
+                        "(default: standard output)")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    micro_parser = subparsers.add_parser("micro", parents=[common],
+                                         help="microbenchmarks")
+    micro_parser.add_argument("--repeat", type=int, default=20)
+    micro_parser.add_argument("--lines", type=int, nargs="+",
+                              default=[1_000, 10_000, 100_000, 1_000_000])
+    micro_parser.add_argument("--blocks", type=int, nargs="+",
+                              default=[1, 10, 100])
+    micro_parser.set_defaults(run=micro)
+
+    e2e_parser = subparsers.add_parser("e2e", parents=[common],
+                                       help="end-to-end latency")
+    e2e_parser.add_argument("--switches", type=int, default=100)
+    e2e_parser.add_argument("--files", type=int, default=5)
+    e2e_parser.add_argument("--file-lines", type=int, default=1_000)
+    e2e_parser.add_argument("--commands", type=int, default=5)
+    e2e_parser.set_defaults(run=e2e)
+
+    imports_parser = subparsers.add_parser(
+        "imports", parents=[common], help="import time budget check")
+    imports_parser.add_argument("--repeat", type=int, default=10)
+    imports_parser.add_argument("--budget-ms", type=float, default=150)
+    imports_parser.set_defaults(run=imports)
+
+    args = parser.parse_args()
+    args.failed = False
+    report = {
+        "suite": args.suite,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": args.run(args),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,67 @@
 #!/usr/bin/env python3
 
-import dbus
+from __future__ import annotations
+
+import argparse
+import difflib
+import errno
+import hashlib
+import json
+import logging
+import mmap
 import os
+import re
+import shlex
+import shutil
+import signal
+import stat
 import subprocess
-import yaml
-from dbus.mainloop.glib import DBusGMainLoop
-from dataclasses import dataclass
-from enum import IntEnum
-from gi.repository import GLib
-from typing import Optional
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from enum import Enum, IntEnum
+from typing import (TYPE_CHECKING, Callable, Iterable, Iterator, Optional,
+                    TypeVar, Union)
+
+# dbus, gi and yaml take long to import, so they are imported by the
+# functions that need them. Keep it that way; see benchmarks/bench.py imports.
+if TYPE_CHECKING:
+    import dbus
 
 
 HOME = os.getenv("HOME", None)
 if HOME is None:
     raise RuntimeError
+# The defaults of the XDG base directory variables, for paths in the config.
+XDG_DEFAULTS = {
+    "XDG_CONFIG_HOME": os.path.join(HOME, ".config"),
+    "XDG_STATE_HOME": os.path.join(HOME, ".local", "state"),
+    "XDG_DATA_HOME": os.path.join(HOME, ".local", "share"),
+    "XDG_CACHE_HOME": os.path.join(HOME, ".cache"),
+}
 CONFIG_DIR = os.path.join(os.getenv("XDG_CONFIG_HOME",
-                                    os.path.join(HOME, ".config")),
+                                    XDG_DEFAULTS["XDG_CONFIG_HOME"]),
                           "theme-switcher")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.yaml")
+STATE_DIR = os.path.join(os.getenv("XDG_STATE_HOME",
+                                   XDG_DEFAULTS["XDG_STATE_HOME"]),
+                         "theme-switcher")
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+RUNTIME_DIR = os.getenv("XDG_RUNTIME_DIR", None)
+METRICS_FILE = None if RUNTIME_DIR is None else \
+    os.path.join(RUNTIME_DIR, "theme-switcher", "metrics.prom")
+
+APPEARANCE_NAMESPACE = "org.freedesktop.appearance"
+COLOR_SCHEME_KEY = "color-scheme"
+SETTINGS_INTERFACE = "org.freedesktop.portal.Settings"
+DAEMON_BUS_NAME = "org.theme_switcher.Daemon"
+DAEMON_OBJECT_PATH = "/org/theme_switcher/Daemon"
+DAEMON_INTERFACE = "org.theme_switcher.Daemon"
+
+log = logging.getLogger("theme-switcher")
 
 
 class theme(IntEnum):
@@ -25,6 +69,19 @@ class theme(IntEnum):
     dark = 1
 
 
+class Durability(Enum):
+    r"""How hard to try to get a rewritten config file onto disk.
+
+    Attributes:
+        none: Leave flushing to the kernel.
+        fdatasync: Flush the file data before it replaces the old file.
+        fsync: Flush the file data and metadata, and the directory entry.
+    """
+    none = "none"
+    fdatasync = "fdatasync"
+    fsync = "fsync"
+
+
 @dataclass
 class Delimiters:
     r"""Defines delimiters used for parsing configuration sections.
@@ -42,18 +99,166 @@ class Delimiters:
     end: str
 
 
+_QUOTED = re.compile("'[^']*'|\"[^\"$`\\\\]*\"")
+_SHELL_CHARACTERS = set("|&;<>()$`\\\"'*?[]{}~#!\n")
+_SHELL_BUILTINS = {
+    ".", ":", "alias", "break", "case", "cd", "command", "continue", "eval",
+    "exec", "exit", "export", "for", "if", "read", "readonly", "return", "set",
+    "shift", "source", "times", "trap", "type", "ulimit", "umask", "unalias",
+    "unset", "until", "wait", "while",
+}
+
+
+def parse_argv(command: str) -> Optional[list[str]]:
+    """Splits a command into an argument vector if it needs no shell.
+
+    A command needs a shell if, outside of quotes, it contains operators,
+    redirections, expansions, globs, escapes or comments, starts with a
+    variable assignment or a shell builtin, or if its program is not found.
+
+    Args:
+        command: The shell command.
+            Example: ``gsettings set org.gnome.desktop.interface cursor-theme
+            'custom'``
+
+    Returns:
+        The argument vector with the program resolved to its path, or None if
+        the command has to be run by the shell.
+    """
+    unquoted = _QUOTED.sub("_", command)
+    if any(c in _SHELL_CHARACTERS for c in unquoted):
+        return None
+    words = unquoted.split()
+    if not words or "=" in words[0] or words[0] in _SHELL_BUILTINS:
+        return None
+    argv = shlex.split(command)
+    program = shutil.which(argv[0])
+    if program is None:
+        return None
+    return [program] + argv[1:]
+
+
+@dataclass
+class Command:
+    """A shell command to be executed when switching between themes.
+
+    Commands are started concurrently. A command that has to wait for other
+    commands lists their names in ``after``.
+
+    Commands that use no shell features are run directly from the argument
+    vector in ``argv``, which is derived from ``run`` when the configuration
+    is loaded. See :func:`parse_argv`.
+
+    Attributes:
+        run: The shell command.
+            Example: ``tmux source-file $XDG_CONFIG_HOME/tmux/tmux.conf``
+        name: The identifier other commands can refer to in ``after``.
+            Example: ``tmux``
+        after: The names of the commands that must finish before this one is
+            started. They must appear earlier in the same list.
+            Example: ``[gtk-theme]``
+        argv: The argument vector, or None if the command needs a shell.
+    """
+    run: str
+    name: Optional[str] = None
+    after: list[str] = field(default_factory=list)
+    argv: Optional[list[str]] = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.argv = parse_argv(self.run)
+
+    @property
+    def label(self) -> str:
+        """Describes the command in logs and reports."""
+        return self.run
+
+
+@dataclass
+class SignalAction:
+    """Sends a signal to running processes, like ``pkill``.
+
+    The processes are found and signalled in-process. All signal actions of a
+    switch share a single scan of ``/proc``.
+
+    Attributes:
+        signal: The name or number of the signal.
+            Example: ``SIGUSR1``
+        process: A regular expression searched for in process names, like
+            ``pgrep`` does.
+            Example: ``kitty``
+        cmdline: A regular expression searched for in full command lines,
+            like ``pgrep -f`` does. Exactly one of ``process`` and ``cmdline``
+            must be given.
+            Example: ``python3 .*/server.py``
+        name: See :class:`Command`.
+        after: See :class:`Command`.
+    """
+    signal: Union[str, int]
+    process: Optional[str] = None
+    cmdline: Optional[str] = None
+    name: Optional[str] = None
+    after: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if (self.process is None) == (self.cmdline is None):
+            raise ValueError("a signal action needs either process or cmdline")
+        if isinstance(self.signal, int):
+            self.signum = signal.Signals(self.signal)
+        else:
+            name = self.signal.upper()
+            self.signum = signal.Signals[name if name.startswith("SIG")
+                                         else f"SIG{name}"]
+        self.pattern = re.compile(self.process or self.cmdline)
+
+    @property
+    def label(self) -> str:
+        """Describes the action in logs and reports."""
+        if self.process is not None:
+            return f"signal {self.signum.name} to process {self.process}"
+        return f"signal {self.signum.name} to cmdline {self.cmdline}"
+
+
+Action = Union[Command, SignalAction]
+
+
+def parse_action(value) -> Action:
+    """Creates an action from a plain string or a mapping of the config."""
+    if isinstance(value, str):
+        return Command(run=value)
+    if "signal" in value:
+        return SignalAction(**value)
+    return Command(**value)
+
+
 @dataclass
 class Commands:
     """Stores the commands to be executed when switching between themes.
 
     Attributes:
         dark_to_light: The list of commands to execute when switching from
-                       dark mode to light mode.
+                       dark mode to light mode. Entries are shell commands
+                       or :class:`SignalAction` entries.
         light_to_dark: The list of commands to execute when switching from
                        light mode to dark mode.
+        max_workers: The maximum number of commands running at once.
     """
-    dark_to_light: list[str]
-    light_to_dark: list[str]
+    dark_to_light: list[Action]
+    light_to_dark: list[Action]
+    max_workers: int = 4
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Creates a Commands instance from a dictionary.
+
+        Raises:
+            ValueError: If an ``after`` entry does not name an earlier command.
+        """
+        dark_to_light = [parse_action(c) for c in data['dark_to_light']]
+        light_to_dark = [parse_action(c) for c in data['light_to_dark']]
+        check_order(dark_to_light)
+        check_order(light_to_dark)
+        return cls(dark_to_light, light_to_dark,
+                   data.get('max_workers', cls.max_workers))
 
 
 @dataclass
@@ -67,10 +272,61 @@ class AppConfig:
             Example: ``$XDG_CONFIG_HOME/kitty/kitty.conf``
         comment_token: The character(s) used for commenting in this file format.
             Example: ``#``
+        comment_open: The token that opens a block comment, for formats
+            without line comments. With ``comment_close``, it replaces
+            ``comment_token``: the inactive lines are commented out by a
+            single block comment, and a switch only rewrites the delimiter
+            lines so that the comment surrounds the other theme. The lines of
+            the themes must not contain ``comment_close`` themselves.
+            Example: ``/*``
+        comment_close: The token that closes a block comment.
+            Example: ``*/``
+        atomic: Whether to write the file to a temporary file and rename it
+            over the original, so readers never see a partially written file.
+        durability: One of ``none``, ``fdatasync`` and ``fsync``. See
+            :class:`Durability`.
+        after: The names of the config files that must be switched before
+            this one. They must appear earlier in the list. Other files are
+            switched concurrently.
+            Example: ``[kitty]``
+        source: The file with the managed sections, if ``path`` is to be a
+            symlink instead. ``<path>.light`` and ``<path>.dark`` are
+            generated from it when it changes, and a switch replaces the
+            symlink with one to the other variant. See
+            :func:`swap_config_file`.
+            Example: ``$XDG_CONFIG_HOME/kitty/kitty.conf.in``
+        include: A file to generate from the managed sections of ``path``,
+            for applications that can include other files. ``path`` is only
+            read: its sections should hold both themes commented out, and
+            ``include`` is rewritten with the lines of the active theme,
+            uncommented. See :func:`include_config_file`.
+            Example: ``$XDG_STATE_HOME/theme-switcher/kitty.theme.conf``
+        matcher: Finds the delimiter lines; set by :class:`Config`.
     """
     name: str
     path: str
-    comment_token: str
+    comment_token: Optional[str] = None
+    comment_open: Optional[str] = None
+    comment_close: Optional[str] = None
+    atomic: bool = True
+    durability: Durability = Durability.none
+    after: list[str] = field(default_factory=list)
+    source: Optional[str] = None
+    include: Optional[str] = None
+    matcher: Optional[LineMatcher] = field(init=False, default=None,
+                                           repr=False, compare=False)
+
+    def __post_init__(self):
+        self.durability = Durability(self.durability)
+        if (self.comment_open is None) != (self.comment_close is None):
+            raise ValueError(f"{self.name}: comment_open and comment_close "
+                             "must be given together")
+        if (self.comment_token is None) == (self.comment_open is None):
+            raise ValueError(f"{self.name}: either comment_token or "
+                             "comment_open and comment_close must be given")
+        if self.source is not None and self.include is not None:
+            raise ValueError(f"{self.name}: source and include cannot be "
+                             "used together")
 
 
 @dataclass
@@ -96,6 +352,27 @@ class Extension:
     settings: list[ExtensionSetting]
 
 
+@dataclass
+class GSetting:
+    """Represents a GSettings key that is set in-process.
+
+    Attributes:
+        schema: The schema of the key.
+            Example: ``org.gnome.desktop.interface``
+        key: The key.
+            Example: ``cursor-theme``
+        light: The value, in GVariant text format, to be set when in light
+            theme mode.
+            Example: ``'custom'``
+        dark: The value to be set when in dark theme mode.
+            Example: ``'custom-white'``
+    """
+    schema: str
+    key: str
+    light: Optional[str]
+    dark: Optional[str]
+
+
 @dataclass
 class Config:
     """Main configuration class that holds all theme switching settings.
@@ -105,11 +382,24 @@ class Config:
         commands: The commands to execute during theme switches
         config_files: The list of configuration files to modify
         extensions: The list of GNOME Shell extensions to configure
+        debounce_ms: How long to wait for further color scheme changes before
+            switching, in milliseconds
+        gsettings: The list of GSettings keys to set
+        file_workers: The maximum number of config files switched at once
     """
     delimiters: Delimiters
     commands: Commands
     config_files: list[AppConfig]
     extensions: list[Extension]
+    debounce_ms: int = 250
+    gsettings: list[GSetting] = field(default_factory=list)
+    file_workers: int = 4
+
+    def __post_init__(self):
+        for app in self.config_files:
+            app.matcher = LineMatcher(self.delimiters,
+                                      app.comment_open or app.comment_token,
+                                      app.comment_close)
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -120,35 +410,150 @@ class Config:
 
         Returns:
             A new Config instance populated with the provided data.
+
+        Raises:
+            ValueError: If an ``after`` entry does not name an earlier command
+                or config file.
         """
         delimiters = Delimiters(**data['delimiters'])
-        commands = Commands(**data['commands'])
+        commands = Commands.from_dict(data['commands'])
         
         config_files = [AppConfig(**cf) for cf in data['config_files']]
+        check_order(config_files)
         
         extensions = []
         for ext in data['extensions']:
             settings = [ExtensionSetting(**setting) for setting in ext['settings']]
             extensions.append(Extension(name=ext['name'], settings=settings))
         
-        return cls(delimiters, commands, config_files, extensions)
+        gsettings = [GSetting(**setting) for setting in data.get('gsettings', [])]
+
+        return cls(delimiters, commands, config_files, extensions,
+                   data.get('debounce_ms', cls.debounce_ms), gsettings,
+                   data.get('file_workers', cls.file_workers))
+
+
+_VARIABLE = re.compile(r"\$(\w+)|\$\{(\w+)\}")
+
+
+def expand_path(path: str) -> str:
+    """Expands the environment variables in a path from the configuration.
+
+    XDG base directory variables that are not set expand to their default
+    values, like ``CONFIG_DIR`` and ``STATE_DIR`` do.
+
+    Raises:
+        ValueError: If the path uses a variable that is not set.
+    """
+    def value(match: re.Match) -> str:
+        name = match.group(1) or match.group(2)
+        result = os.environ.get(name, XDG_DEFAULTS.get(name))
+        if result is None:
+            raise ValueError(f"{path}: ${name} is not set")
+        return result
+
+    return _VARIABLE.sub(value, path)
+
+
+@dataclass(frozen=True)
+class ResolvedPaths:
+    """The paths of a config file, with their variables expanded.
 
+    Attributes:
+        path: The config file, or the symlink for a file with a ``source``.
+        source: The file the variants are generated from, if any.
+        include: The file the sections are written to, if any.
+    """
+    path: str
+    source: Optional[str] = None
+    include: Optional[str] = None
+
+    @property
+    def tracked(self) -> str:
+        """The file whose status the journal records: the source, if any."""
+        return self.path if self.source is None else self.source
+
+
+def resolve_paths(app: AppConfig) -> ResolvedPaths:
+    """Expands the paths of a config file with :func:`expand_path`.
+
+    Raises:
+        ValueError: If a path uses a variable that is not set.
+    """
+    return ResolvedPaths(
+        path=expand_path(app.path),
+        source=None if app.source is None else expand_path(app.source),
+        include=None if app.include is None else expand_path(app.include),
+    )
 
-def load_config() -> Config:
-    r"""Loads configuration from ``CONFIG_FILE``."""
-    with open(CONFIG_FILE, 'r') as file:
-        config_dict = yaml.safe_load(file)
+
+def load_config(path: str = CONFIG_FILE) -> Config:
+    r"""Loads configuration from ``path``, ``CONFIG_FILE`` by default."""
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path, 'r') as file:
+        config_dict = yaml.load(file, Loader=loader)
     return Config.from_dict(config_dict)
 
 
-def comment(line: str, comment_token: str) -> str:
-    r"""Comment a line with the given comment token.
+def check_order(items: list):
+    r"""Checks that every ``after`` entry names an earlier item of the list.
+
+    Requiring dependencies to be listed first rules out cycles and lets
+    :func:`run_ordered` submit the items in list order.
+
+    Raises:
+        ValueError: If a dependency is unknown or listed later.
+    """
+    seen: set[str] = set()
+    for item in items:
+        for name in item.after:
+            if name not in seen:
+                raise ValueError(f"{name!r} must be listed before the entry "
+                                 f"that depends on it")
+        if item.name is not None:
+            seen.add(item.name)
+
 
-    .. TODO::
-       Add support for closing comment token.
+T = TypeVar("T")
+R = TypeVar("R")
 
-       Currently, only config files with a comment token on the beginning of
-       the line are supported.
+
+def run_ordered(items: list[T], fn: Callable[[T], R],
+                max_workers: int) -> list[R]:
+    r"""Calls ``fn`` on every item in a bounded thread pool.
+
+    An item is started only after the items named in its ``after`` attribute
+    have finished. Since the pool takes work in submission order and
+    :func:`check_order` guarantees that dependencies are submitted first, a
+    waiting item never blocks the items it waits for.
+
+    Args:
+        items: Objects with ``name`` and ``after`` attributes.
+        fn: The function to call on each item.
+        max_workers: The size of the thread pool.
+
+    Returns:
+        The results of ``fn`` in the order of ``items``.
+    """
+    def run_after(deps, item):
+        wait(deps)
+        return fn(item)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        named = {}
+        futures = []
+        for item in items:
+            future = pool.submit(run_after,
+                                 [named[name] for name in item.after], item)
+            if item.name is not None:
+                named[item.name] = future
+            futures.append(future)
+        return [future.result() for future in futures]
+
+
+def comment(line: str, comment_token: str) -> str:
+    r"""Comment a line with the given comment token.
 
     Args:
         line: The line to be commented.
@@ -165,12 +570,6 @@ def comment(line: str, comment_token: str) -> str:
 def uncomment(line: str, comment_token: str) -> str:
     r"""Uncomment a line with the given comment token.
 
-    .. TODO::
-       Add support for closing comment token.
-
-       Currently, only config files with a comment token on the beginning of
-       the line are supported.
-
     Args:
         line: The line to be uncommented.
         comment_token: The comment token.
@@ -183,67 +582,1131 @@ def uncomment(line: str, comment_token: str) -> str:
     return line[len(comment_token):].lstrip()
 
 
-def modify_config_file(config: Config, file: str, comment_token: str, t: theme):
-    r"""Comment/uncomment lines in a config file depending on the theme
+def sync(fd: int, durability: Durability):
+    """Flushes a file descriptor according to the durability level."""
+    if durability == Durability.fdatasync:
+        os.fdatasync(fd)
+    elif durability == Durability.fsync:
+        os.fsync(fd)
+
 
-    .. TODO::
-       Add support for closing comment token.
+def write_file(path: str, lines: list[str], atomic: bool = True,
+               durability: Durability = Durability.none):
+    r"""Writes lines to a file.
 
-       Currently, only config files with a comment token on the beginning of
-       the line are supported.
+    In atomic mode, the lines are written to a temporary file in the same
+    directory as the file (the target if ``path`` is a symlink), which then
+    replaces it with :func:`os.replace`. The mode and, if permitted, the owner
+    of the old file are preserved.
 
     Args:
-        config: The loaded configuration.
-        file: The path to the config file.
-        comment_token: The comment token.
-        t: The theme.
+        path: The path to the file.
+        lines: The lines to write.
+        atomic: Whether to replace the file atomically.
+        durability: How to flush the file before returning.
     """
-    path = os.path.expandvars(file)
+    if not atomic:
+        with open(path, "w") as f:
+            f.writelines(lines)
+            f.flush()
+            sync(f.fileno(), durability)
+        return
 
-    with open(file, "r") as f:
-        lines = f.readlines()
+    def write(fd: int):
+        with open(fd, "w", closefd=False) as f:
+            f.writelines(lines)
+
+    replace_file(path, write, durability)
+
+
+def replace_file(path: str, write: Callable[[int], None],
+                 durability: Durability = Durability.none):
+    """Replaces a file atomically with what ``write`` writes.
+
+    See :func:`write_file`.
+
+    Args:
+        path: The path to the file.
+        write: Writes the new contents to the file descriptor it is given.
+        durability: How to flush the file before returning.
+    """
+    target = os.path.realpath(path)
+    directory, name = os.path.split(target)
+    try:
+        st: Optional[os.stat_result] = os.stat(target)
+    except FileNotFoundError:
+        st = None
+
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        try:
+            write(fd)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode) if st else 0o644)
+            if st and (st.st_uid, st.st_gid) != (os.getuid(), os.getgid()):
+                try:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                except PermissionError:
+                    pass
+            sync(fd, durability)
+        finally:
+            os.close(fd)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    if durability == Durability.fsync:
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+@dataclass(frozen=True)
+class Section:
+    """The line numbers of the delimiters of a managed section of a file.
+
+    Attributes:
+        begin: The index of the line with the begin delimiter.
+        separator: The index of the line with the separator, or ``end`` if the
+            section has no separator.
+        end: The index of the line with the end delimiter, or the number of
+            lines if the section is not terminated.
+    """
+    begin: int
+    separator: int
+    end: int
+
+    @property
+    def light(self) -> range:
+        """The indices of the light theme lines."""
+        return range(self.begin + 1, self.separator)
+
+    @property
+    def dark(self) -> range:
+        """The indices of the dark theme lines."""
+        return range(self.separator + 1, self.end)
 
-    section: Optional[theme] = None
-    for i, line in enumerate(lines):
-        cleaned_line = line.replace(comment_token, "").strip()
 
-        if cleaned_line == config.delimiters.begin:
-            section = theme.light
+class LineMatcher:
+    """Finds the lines of a config file that may be delimiters.
+
+    A delimiter line holds a delimiter, optionally preceded by whitespace and
+    comment tokens and followed by whitespace and, in block comment mode, the
+    closing token. Comment tokens elsewhere in the line are part of its
+    content, so that e.g. ``color #ffffff`` is not mistaken for
+    ``color ffffff``. Lines that contain none of the delimiters are skipped
+    with a substring search, without allocating.
+
+    Attributes:
+        delimiters: The delimiters of the sections.
+        comment_token: The comment token, or the opening token of block
+            comments.
+        close_token: The closing token of block comments, if any.
+        key: Identifies the matching rules in cache keys.
+    """
+    def __init__(self, delimiters: Delimiters, comment_token: str,
+                 close_token: Optional[str] = None):
+        self.delimiters = delimiters
+        self.comment_token = comment_token
+        self.close_token = close_token
+        self.key = (delimiters.begin, delimiters.separator, delimiters.end,
+                    comment_token, close_token)
+        self._prefix = re.compile(
+            rf"[ \t]*(?:{re.escape(comment_token)}[ \t]*)*")
+
+    def text(self, line: str) -> str:
+        """Strips the comment tokens and surrounding whitespace from a line."""
+        text = line[self._prefix.match(line).end():].rstrip()
+        close = self.close_token
+        if close and text.endswith(close):
+            text = text[:-len(close)].rstrip()
+        return text
+
+    def candidates(self, lines: list[str]) -> Iterator[tuple[int, str]]:
+        """Yields ``(index, text)`` for each line that contains a delimiter.
+
+        The text is as returned by :meth:`text`.
+        """
+        begin, separator, end = (self.delimiters.begin,
+                                 self.delimiters.separator,
+                                 self.delimiters.end)
+        text = self.text
+        for i, line in enumerate(lines):
+            if begin in line or separator in line or end in line:
+                yield i, text(line)
+
+    def offsets(self, data: bytes) -> list[tuple[int, str]]:
+        """Finds the lines of UTF-8 encoded data that contain a delimiter.
+
+        The delimiters are searched for in ``data`` directly, which may be a
+        :class:`mmap.mmap`, so only the lines that contain one are decoded.
+
+        Returns:
+            The offset and the text, as returned by :meth:`text`, of each
+            line.
+        """
+        starts = set()
+        for delimiter in {self.delimiters.begin, self.delimiters.separator,
+                          self.delimiters.end}:
+            needle = delimiter.encode()
+            position = data.find(needle)
+            while position != -1:
+                starts.add(data.rfind(b"\n", 0, position) + 1)
+                position = data.find(needle, position + len(needle))
+        candidates = []
+        for start in sorted(starts):
+            stop = data.find(b"\n", start)
+            line = data[start:len(data) if stop == -1 else stop]
+            candidates.append((start, self.text(line.decode(errors="replace"))))
+        return candidates
+
+
+def scan_sections(lines: list[str], matcher: LineMatcher) -> list[Section]:
+    """Finds the managed sections in the lines of a config file.
+
+    Args:
+        lines: The lines of the file.
+        matcher: The matcher of the delimiter lines.
+
+    Returns:
+        The sections in the order they appear in the file.
+    """
+    return match_sections(matcher.candidates(lines), len(lines),
+                          matcher.delimiters)
+
+
+def match_sections(candidates: Iterable[tuple[int, str]], stop: int,
+                   delimiters: Delimiters) -> list[Section]:
+    """Pairs delimiter lines into sections.
+
+    Args:
+        candidates: The position and the text without comment tokens of the
+            lines that may be delimiters, in order.
+        stop: The position to use as the end of an unterminated section.
+        delimiters: The delimiters of the sections.
+
+    Returns:
+        The sections, with the positions of their delimiter lines.
+    """
+    sections = []
+    begin: Optional[int] = None
+    separator: Optional[int] = None
+    for i, cleaned_line in candidates:
+        if cleaned_line == delimiters.begin:
+            begin = i
+            separator = None
+            continue
+        if begin is None:
             continue
-        if section == theme.light and cleaned_line.startswith(config.delimiters.separator):
-            section = theme.dark
+        if separator is None and cleaned_line.startswith(delimiters.separator):
+            separator = i
             continue
-        if cleaned_line == config.delimiters.end:
-            break
+        if cleaned_line == delimiters.end:
+            sections.append(Section(begin, i if separator is None else separator, i))
+            begin = None
+
+    if begin is not None:
+        sections.append(Section(begin, stop if separator is None else separator,
+                                stop))
+    return sections
+
+
+_section_index: dict[str, tuple[tuple, list[Section]]] = {}
+# The byte ranges of the sections of files switched by stream_config_file.
+_span_index: dict[str, tuple[tuple, list[tuple[int, int]]]] = {}
+# The source keys and section counts of the variants of swap_config_file.
+_variant_index: dict[str, tuple[str, int]] = {}
+# The section counts and theme lines of the files read by include_config_file.
+_include_index: dict[str, tuple[tuple, int, dict[theme, list[str]]]] = {}
+
+
+def file_key(st: os.stat_result, matcher: LineMatcher) -> tuple:
+    """Returns the key under which the sections of a file are cached."""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, *matcher.key)
+
+
+def find_sections(path: str, st: os.stat_result, lines: list[str],
+                  matcher: LineMatcher) -> list[Section]:
+    """Returns the sections of a file, scanning it only if it has changed.
+
+    The sections are cached by path and keyed by the inode, size and
+    modification time of the file, so a file that has not been touched since
+    the last switch is not parsed again.
+
+    Args:
+        path: The path to the file.
+        st: The status of the file from which ``lines`` were read.
+        lines: The lines of the file.
+        matcher: The matcher of the delimiter lines.
+
+    Returns:
+        The sections of the file.
+    """
+    key = file_key(st, matcher)
+    cached = _section_index.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    sections = scan_sections(lines, matcher)
+    _section_index[path] = (key, sections)
+    return sections
+
+
+def switch_lines(lines: list[str], sections: list[Section], t: theme,
+                 comment_token: str) -> bool:
+    """Comments the inactive and uncomments the active lines of the sections.
 
+    Args:
+        lines: The lines of the file, modified in place.
+        sections: The managed sections of the file.
+        t: The theme.
+        comment_token: The comment token.
+
+    Returns:
+        Whether any line changed.
+    """
+    changed = False
+    for section in sections:
         if t == theme.dark:
-            if section == theme.light:
-                lines[i] = comment(lines[i], comment_token)
-            else:
-                lines[i] = uncomment(lines[i], comment_token)
+            active, inactive = section.dark, section.light
         else:
-            if section == theme.dark:
-                lines[i] = comment(lines[i], comment_token)
-            else:
-                lines[i] = uncomment(lines[i], comment_token)
+            active, inactive = section.light, section.dark
+        for i in inactive:
+            line = comment(lines[i], comment_token)
+            if line != lines[i]:
+                lines[i] = line
+                changed = True
+        for i in active:
+            line = uncomment(lines[i], comment_token)
+            if line != lines[i]:
+                lines[i] = line
+                changed = True
+    return changed
+
+
+def switch_markers(lines: list[str], sections: list[Section], t: theme,
+                   matcher: LineMatcher) -> bool:
+    """Moves the block comment of each section onto the inactive theme.
+
+    Only the delimiter lines are rewritten: a delimiter line opens a comment
+    unless it is already inside one, and closes it if the lines after it are
+    active. With the light theme active, a section reads::
+
+        /* <<< theme-switcher <<< */
+        light lines
+        /* =====
+        dark lines
+        >>> theme-switcher >>> */
+
+    Args:
+        lines: The lines of the file, modified in place.
+        sections: The managed sections of the file.
+        t: The theme.
+        matcher: The matcher of the block comment file.
+
+    Returns:
+        Whether any line changed.
+    """
+    open_token, close_token = matcher.comment_token, matcher.close_token
+    changed = False
+    for section in sections:
+        markers = [(section.begin, t == theme.light)]
+        if section.separator < section.end:
+            markers.append((section.separator, t == theme.dark))
+        if section.end < len(lines):
+            markers.append((section.end, True))
+        in_comment = False
+        for i, active_after in markers:
+            line = lines[i]
+            body = line.lstrip(" \t")
+            indent = line[:len(line) - len(body)]
+            newline = line[len(line.rstrip("\r\n")):]
+            text = matcher.text(line)
+            if not in_comment:
+                text = f"{open_token} {text}"
+            if active_after:
+                text = f"{text} {close_token}"
+            in_comment = not active_after
+            line = f"{indent}{text}{newline}"
+            if line != lines[i]:
+                lines[i] = line
+                changed = True
+    return changed
+
+
+def switch_file_lines(app: AppConfig, lines: list[str],
+                      sections: list[Section], t: theme) -> bool:
+    """Switches the sections of a config file with the method of ``app``."""
+    if app.comment_close is not None:
+        return switch_markers(lines, sections, t, app.matcher)
+    return switch_lines(lines, sections, t, app.comment_token)
+
+
+STREAMING_SIZE = 1 << 20
+"""Files of at least this many bytes are switched by
+:func:`stream_config_file`."""
+
+
+def copy_range(src: int, dst: int, offset: int, count: int):
+    """Copies bytes of a file to the current position of another one.
+
+    The data is copied in the kernel with :func:`os.copy_file_range`, or
+    with :func:`os.sendfile` where that is not supported, e.g. across file
+    systems. Otherwise it is read and written.
+
+    Args:
+        src: The file descriptor to copy from.
+        dst: The file descriptor to copy to.
+        offset: The position in ``src`` to copy from.
+        count: The number of bytes to copy.
+    """
+    end = offset + count
+    copiers = [lambda: os.sendfile(dst, src, offset, end - offset),
+               lambda: os.write(dst, os.pread(src, min(end - offset, 1 << 20),
+                                              offset))]
+    if hasattr(os, "copy_file_range"):
+        copiers.insert(0, lambda: os.copy_file_range(src, dst, end - offset,
+                                                     offset))
+    for copy in copiers:
+        try:
+            while offset < end:
+                copied = copy()
+                if copied == 0:
+                    raise OSError(errno.EIO, "file shrank while being copied")
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF):
+                raise
+
+
+def split_lines(text: str) -> list[str]:
+    """Splits text into lines at line feeds only, keeping them."""
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def stream_config_file(app: AppConfig, t: theme, path: str, fd: int,
+                       st: os.stat_result) -> tuple[int, bool, int]:
+    """Switches a large config file without reading all of it.
+
+    The file is mapped into memory and the delimiters are found by searching
+    its bytes, so only the managed sections are decoded and switched. The new
+    file is assembled in a temporary file from the rewritten sections and,
+    in between, ranges copied from the old file by :func:`copy_range`, and
+    then replaces the file even if ``app.atomic`` is false. The file must be
+    UTF-8 encoded.
+
+    Args:
+        app: The config file to modify.
+        t: The theme.
+        path: The path to the file.
+        fd: A file descriptor of the file, open for reading.
+        st: The status of the file.
+
+    Returns:
+        The number of managed sections, whether the file was rewritten and
+        how many bytes were written.
+    """
+    key = file_key(st, app.matcher)
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        cached = _span_index.get(path)
+        if cached is not None and cached[0] == key:
+            spans = cached[1]
+        else:
+            spans = []
+            for section in match_sections(app.matcher.offsets(data), size,
+                                          app.matcher.delimiters):
+                stop = data.find(b"\n", section.end)
+                spans.append((section.begin, size if stop == -1 else stop + 1))
+
+        edits = []
+        for start, stop in spans:
+            lines = split_lines(data[start:stop].decode())
+            if switch_file_lines(app, lines, scan_sections(lines, app.matcher),
+                                 t):
+                edits.append((start, stop, "".join(lines).encode()))
+        if not edits:
+            _span_index[path] = (key, spans)
+            return len(spans), False, 0
+
+        def write(out: int):
+            position = 0
+            for start, stop, new in edits:
+                copy_range(fd, out, position, start - position)
+                with open(out, "wb", closefd=False) as f:
+                    f.write(new)
+                position = stop
+            copy_range(fd, out, position, size - position)
+
+        replace_file(path, write, app.durability)
+
+    # Keep the index valid by moving the spans by the change in size of the
+    # sections before them.
+    new_spans = []
+    shift = 0
+    edited = {start: len(new) - (stop - start) for start, stop, new in edits}
+    for start, stop in spans:
+        new_start = start + shift
+        shift += edited.get(start, 0)
+        new_spans.append((new_start, stop + shift))
+    _span_index[path] = (file_key(os.stat(path), app.matcher), new_spans)
+    return len(spans), True, size + shift
+
+
+def swap_config_file(app: AppConfig, t: theme,
+                     paths: ResolvedPaths) -> tuple[int, bool, int]:
+    """Switches a config file by pointing a symlink to a prebuilt variant.
+
+    ``<path>.light`` and ``<path>.dark`` are generated from ``app.source``
+    whenever it or the way it is parsed changes, or a variant is missing.
+    What they were generated from is recorded in ``.<name>.variants`` next
+    to them, so that this still holds after a restart. ``path`` is then
+    replaced by a relative symlink to the variant of the theme with a single
+    :func:`os.replace`, so a switch costs the same for any file size and
+    readers never see a partial file.
+
+    Args:
+        app: The config file to modify.
+        t: The theme.
+        paths: The resolved paths of the symlink and the source.
+
+    Returns:
+        The number of managed sections in the source, whether the symlink or
+        a variant was rewritten and how many bytes were written, which is 0
+        if only the symlink was replaced.
+
+    Raises:
+        FileExistsError: If ``path`` exists and is not a symlink.
+    """
+    path, source = paths.path, paths.source
+    if os.path.lexists(path) and not os.path.islink(path):
+        raise FileExistsError(f"{path} is not a symlink; move it to {source}")
+
+    st = os.stat(source)
+    key = digest(file_key(st, app.matcher))
+    variants = {mode: f"{path}.{mode.name}" for mode in theme}
+    directory, name = os.path.split(path)
+    sidecar = os.path.join(directory, f".{name}.variants")
+
+    written = 0
+    cached = _variant_index.get(path)
+    if cached is None:
+        # After a restart, the sidecar tells what the variants were made from.
+        try:
+            with open(sidecar, "r") as f:
+                data = json.load(f)
+            cached = (data["key"], data["sections"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    if cached is not None and cached[0] == key and \
+            all(os.path.exists(variant) for variant in variants.values()):
+        count = cached[1]
+    else:
+        with open(source, "r") as f:
+            lines = f.readlines()
+        sections = scan_sections(lines, app.matcher)
+        count = len(sections)
+        for mode, variant in variants.items():
+            variant_lines = list(lines)
+            switch_file_lines(app, variant_lines, sections, mode)
+            write_file(variant, variant_lines, durability=app.durability)
+            written += os.stat(variant).st_size
+        write_file(sidecar, [json.dumps({"key": key, "sections": count})],
+                   durability=app.durability)
+    _variant_index[path] = (key, count)
+
+    target = os.path.basename(variants[t])
+    try:
+        if os.readlink(path) == target:
+            return count, written > 0, written
+    except FileNotFoundError:
+        pass
+    tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    os.symlink(target, tmp)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    if app.durability == Durability.fsync:
+        dir_fd = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return count, True, written
+
+
+def theme_lines(app: AppConfig, lines: list[str], sections: list[Section],
+                t: theme) -> list[str]:
+    """Returns the lines of a theme from all sections, as when active."""
+    lines = list(lines)
+    switch_file_lines(app, lines, sections, t)
+    return [lines[i] for section in sections
+            for i in (section.light if t == theme.light else section.dark)]
+
+
+def include_lines(app: AppConfig, t: theme,
+                  path: str) -> tuple[int, list[str]]:
+    """Returns the number of sections of a file and the include of a theme.
+
+    The lines of both themes are kept until the file changes, so a switch
+    does not read it again.
+    """
+    with open(path, "r") as f:
+        key = file_key(os.fstat(f.fileno()), app.matcher)
+        cached = _include_index.get(path)
+        if cached is None or cached[0] != key:
+            lines = f.readlines()
+            sections = scan_sections(lines, app.matcher)
+            cached = (key, len(sections),
+                      {mode: theme_lines(app, lines, sections, mode)
+                       for mode in theme})
+            _include_index[path] = cached
+    return cached[1], cached[2][t]
+
+
+def include_config_file(app: AppConfig, t: theme,
+                        paths: ResolvedPaths) -> tuple[int, bool, int]:
+    """Writes the lines of a theme to the include file of a config file.
+
+    ``path`` is left as it is. ``app.include`` is only written if its
+    contents change, so a switch costs as much as the managed lines, however
+    large ``path`` is.
+
+    Args:
+        app: The config file to modify.
+        t: The theme.
+        paths: The resolved paths of the config file and the include.
+
+    Returns:
+        The number of managed sections, whether the include was rewritten and
+        how many bytes were written.
+    """
+    count, lines = include_lines(app, t, paths.path)
+    include = paths.include
+    try:
+        with open(include, "r") as f:
+            if f.read() == "".join(lines):
+                return count, False, 0
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(include), exist_ok=True)
+    write_file(include, lines, app.atomic, app.durability)
+    return count, True, os.stat(include).st_size
+
+
+def modify_config_file(config: Config, app: AppConfig, t: theme,
+                       paths: Optional[ResolvedPaths] = None
+                       ) -> tuple[int, bool, int]:
+    r"""Comment/uncomment lines in a config file depending on the theme
+
+    All managed sections of the file are handled in one pass. The file is only
+    written if at least one line changes, so that watchers of files that are
+    already in the requested state are not triggered. Only the lines inside
+    the managed sections are touched, or only the delimiter lines for files
+    with block comments (see :func:`switch_markers`). Files of at least
+    ``STREAMING_SIZE`` bytes are handled by :func:`stream_config_file`,
+    files with a ``source`` by :func:`swap_config_file` and files with an
+    ``include`` by :func:`include_config_file`.
+
+    Args:
+        config: The loaded configuration.
+        app: The config file to modify.
+        t: The theme.
+        paths: The paths of the file, if already resolved from ``app``.
 
-    with open(path, "w") as f:
-        f.writelines(lines)
+    Returns:
+        The number of managed sections, whether the file was rewritten and
+        how many bytes were written.
+    """
+    if paths is None:
+        paths = resolve_paths(app)
+    if app.source is not None:
+        return swap_config_file(app, t, paths)
+    if app.include is not None:
+        return include_config_file(app, t, paths)
+
+    path = paths.path
+
+    with open(path, "r") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size >= STREAMING_SIZE:
+            return stream_config_file(app, t, path, f.fileno(), st)
+        lines = f.readlines()
+
+    sections = find_sections(path, st, lines, app.matcher)
+    changed = switch_file_lines(app, lines, sections, t)
+    if not changed:
+        return len(sections), False, 0
+    write_file(path, lines, app.atomic, app.durability)
+    # Commenting never adds or removes lines, so the sections are unchanged.
+    st = os.stat(path)
+    _section_index[path] = (file_key(st, app.matcher), sections)
+    return len(sections), True, st.st_size
+
+
+def diff_config_file(config: Config, app: AppConfig, t: theme,
+                     paths: Optional[ResolvedPaths] = None) -> list[str]:
+    """Returns how :func:`modify_config_file` would change a config file.
+
+    Args:
+        config: The loaded configuration.
+        app: The config file to modify.
+        t: The theme.
+        paths: The paths of the file, if already resolved from ``app``.
+
+    Returns:
+        The lines of a unified diff, empty if the file would not change. For
+        files with a ``source``, the symlink that would be made instead, and
+        for files with an ``include``, the diff of the include.
+    """
+    if paths is None:
+        paths = resolve_paths(app)
+    path = paths.path
+    if app.source is not None:
+        target = f"{os.path.basename(path)}.{t.name}"
+        if os.path.islink(path) and os.readlink(path) == target:
+            return []
+        return [f"symlink {path} -> {target}\n"]
+    if app.include is not None:
+        include = paths.include
+        try:
+            with open(include, "r") as f:
+                old_lines = f.readlines()
+        except FileNotFoundError:
+            old_lines = []
+        return list(difflib.unified_diff(
+            old_lines, include_lines(app, t, path)[1], include, include))
+    with open(path, "r") as f:
+        lines = f.readlines()
+    new_lines = list(lines)
+    sections = scan_sections(lines, app.matcher)
+    if not switch_file_lines(app, new_lines, sections, t):
+        return []
+    return list(difflib.unified_diff(lines, new_lines, path, path))
+
+
+def digest(*parts) -> str:
+    """Returns a short hash of the representation of the given objects."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+class StateStore:
+    r"""Journal of what was applied, kept in ``STATE_FILE``.
+
+    Every config file, command and extension setting is recorded under an
+    item name together with the theme it was applied for and a hash of what
+    was applied, so that a switch can skip the items that are already in the
+    target state and an interrupted switch can be resumed.
+
+    Config files are journaled by their status, so their entries stay valid
+    across switches. Commands, GSettings keys and DConf keys cannot be checked
+    that way: their entries only serve to resume an unfinished switch to the
+    same theme, and are dropped when any other switch begins.
 
+    Items are recorded in memory from any thread and written by :meth:`save`.
+
+    Attributes:
+        path: The path to the journal.
+        theme: The theme that was applied completely, if any.
+        plan: The hash of the plan that applied ``theme``, if any.
+        target: The theme of the switch in progress or applied last.
+        items: Maps item names to ``{"theme": ..., "hash": ...}``.
+    """
+    def __init__(self, path: str = STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        self.theme: Optional[theme] = theme.__members__.get(data.get("theme"))
+        plan = data.get("plan")
+        self.plan: Optional[str] = plan if isinstance(plan, str) else None
+        self.target: Optional[theme] = theme.__members__.get(data.get("target"))
+        items = data.get("items")
+        self.items: dict[str, dict] = items if isinstance(items, dict) else {}
+
+    def begin(self, mode: theme):
+        """Starts recording a switch to the given theme."""
+        with self._lock:
+            if self.theme is not None or self.target != mode:
+                self.items = {item: entry for item, entry in self.items.items()
+                              if item.startswith("file:")}
+            self.theme = None
+            self.plan = None
+            self.target = mode
+        self.save()
+
+    def finish(self, plan_hash: str):
+        """Records that the switch was completed by the plan with the hash."""
+        with self._lock:
+            self.theme = self.target
+            self.plan = plan_hash
+        self.save()
+
+    def is_done(self, item: str, item_hash: str) -> bool:
+        """Returns whether the item was applied for the target theme."""
+        with self._lock:
+            entry = self.items.get(item)
+            return entry is not None and self.target is not None and \
+                entry.get("theme") == self.target.name and \
+                entry.get("hash") == item_hash
+
+    def mark(self, item: str, item_hash: str):
+        """Records that the item was applied for the target theme."""
+        with self._lock:
+            if self.target is not None:
+                self.items[item] = {"theme": self.target.name,
+                                    "hash": item_hash}
+
+    def save(self):
+        """Writes the journal; errors are logged and otherwise ignored."""
+        with self._lock:
+            data = json.dumps({
+                "theme": None if self.theme is None else self.theme.name,
+                "plan": self.plan,
+                "target": None if self.target is None else self.target.name,
+                "items": self.items,
+            })
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_file(self.path, [data])
+        except OSError as e:
+            log.warning("cannot save state: %s", e)
+
+
+@dataclass
+class ItemReport:
+    """The outcome of a single item of a switch.
 
-def run_command(command: str) -> tuple[int, str]:
-    """Runs a shell command and returns its exit code and output."""
-    process = subprocess.run(command, shell=True, text=True, capture_output=True)
+    Attributes:
+        phase: ``files``, ``gsettings``, ``commands`` or ``extensions``.
+        item: The name of the config file, the GSettings schema and key, the
+            command or the DConf key.
+        status: What happened, e.g. ``rewritten``, ``unchanged``, ``skipped``,
+            ``ok`` or ``failed``.
+        seconds: How long the item took.
+        exit_code: The exit code, for commands.
+        bytes: The number of bytes written, for config files.
+        via: ``exec``, ``shell`` or ``builtin``, for commands, GSettings keys
+            and DConf keys that were set.
+    """
+    phase: str
+    item: str
+    status: str
+    seconds: float
+    exit_code: Optional[int] = None
+    bytes: int = 0
+    via: Optional[str] = None
+
+
+@dataclass
+class SwitchReport:
+    """Timings and outcomes of a switch.
+
+    Items may be added from several threads.
+
+    Attributes:
+        theme: The theme that was switched to.
+        started: The wall-clock time the switch started at.
+        seconds: How long the switch took.
+        completed: Whether the theme was applied completely.
+        phases: Maps phases to their durations.
+        items: The outcomes of the items.
+    """
+    theme: theme
+    started: float = field(default_factory=time.time)
+    seconds: float = 0.0
+    completed: bool = False
+    phases: dict[str, float] = field(default_factory=dict)
+    items: list[ItemReport] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, *args, **kwargs):
+        """Adds an :class:`ItemReport` with the given fields."""
+        item = ItemReport(*args, **kwargs)
+        with self._lock:
+            self.items.append(item)
+
+    def to_dict(self) -> dict:
+        """Returns the report as a JSON-serializable dictionary."""
+        return {
+            "theme": self.theme.name,
+            "started": self.started,
+            "seconds": self.seconds,
+            "completed": self.completed,
+            "phases": self.phases,
+            "items": [vars(item) for item in self.items],
+        }
+
+
+def run_command(command: Union[str, list[str]]) -> tuple[int, str]:
+    """Runs a command and returns its exit code and output.
+
+    A string is run by the shell. An argument vector is executed directly;
+    with ``close_fds=False``, :mod:`subprocess` can use ``posix_spawn`` for
+    it instead of ``fork`` and ``exec``.
+    """
+    if isinstance(command, str):
+        process = subprocess.run(command, shell=True, text=True, capture_output=True)
+    else:
+        try:
+            process = subprocess.run(command, text=True, capture_output=True,
+                                     close_fds=False)
+        except OSError as e:
+            return 127, str(e)
     return process.returncode, process.stdout + process.stderr
 
 
-def apply_extension_settings(config: Config, mode: theme):
-    """Applies theme-specific settings to GNOME Shell extensions.
+def never() -> bool:
+    return False
+
+
+def gsettings_changes(config: Config, mode: theme) -> list[tuple[str, str, str]]:
+    """Returns the GSettings schemas, keys and values to set for the theme."""
+    changes = []
+    for setting in config.gsettings:
+        value = setting.light if mode == theme.light else setting.dark
+        if value is not None:
+            changes.append((setting.schema, setting.key, value))
+    return changes
+
+
+def write_gsettings(schema_id: str, values: list[tuple[str, str]]):
+    r"""Sets keys of a GSettings schema in-process.
+
+    The keys are set between ``delay()`` and ``apply()``, so that they are
+    written as one change, and flushed with ``Gio.Settings.sync()``.
+
+    Args:
+        schema_id: The schema.
+        values: The ``(key, value)`` pairs, with values in GVariant text
+            format.
+
+    Raises:
+        GLib.Error: If a value cannot be parsed.
+        ValueError: If the schema or a key does not exist.
+    """
+    from gi.repository import Gio, GLib
+
+    source = Gio.SettingsSchemaSource.get_default()
+    schema = None if source is None else source.lookup(schema_id, True)
+    if schema is None:
+        raise ValueError(f"no schema {schema_id}")
+    settings = Gio.Settings.new_full(schema, None, None)
+    settings.delay()
+    for key, value in values:
+        if not schema.has_key(key):
+            raise ValueError(f"no key {key} in schema {schema_id}")
+        value_type = schema.get_key(key).get_value_type()
+        settings.set_value(key, GLib.Variant.parse(value_type, value, None, None))
+    settings.apply()
+    Gio.Settings.sync()
+
+
+def apply_gsettings(changes: list[tuple[str, str, str]],
+                    store: Optional[StateStore] = None,
+                    report: Optional[SwitchReport] = None):
+    """Sets GSettings keys, batched per schema.
+
+    Each schema is written with :func:`write_gsettings`. If that fails, or
+    if PyGObject is not available, ``gsettings set`` is executed once per key
+    of the schema, which also accepts strings without quotes.
+
+    Args:
+        changes: The ``(schema, key, value)`` triples to set.
+        store: If given, keys that were already set for the target theme are
+            skipped, and keys that are set are recorded.
+        report: If given, the outcome of each key is added to it. Keys of a
+            schema share its duration.
+    """
+    schemas: dict[str, list[tuple[str, str]]] = {}
+    for schema_id, key, value in changes:
+        item = f"gsettings:{schema_id}/{key}"
+        if store is not None and store.is_done(item, digest(value)):
+            if report is not None:
+                report.add("gsettings", f"{schema_id} {key}", "skipped", 0.0)
+            continue
+        schemas.setdefault(schema_id, []).append((key, value))
+
+    if not schemas:
+        return
+    try:
+        from gi.repository import GLib
+        errors: Optional[tuple[type[Exception], ...]] = (GLib.Error, ValueError)
+    except ImportError:
+        errors = None
+
+    gsettings = shutil.which("gsettings") or "gsettings"
+    for schema_id, values in schemas.items():
+        if errors is not None:
+            start = time.perf_counter()
+            try:
+                write_gsettings(schema_id, values)
+            except errors as e:
+                log.warning("falling back to gsettings set: %s", e)
+            else:
+                seconds = time.perf_counter() - start
+                for key, value in values:
+                    if store is not None:
+                        store.mark(f"gsettings:{schema_id}/{key}",
+                                   digest(value))
+                    if report is not None:
+                        report.add("gsettings", f"{schema_id} {key}", "ok",
+                                   seconds, via="builtin")
+                continue
+        for key, value in values:
+            start = time.perf_counter()
+            code, output = run_command([gsettings, "set", schema_id, key, value])
+            if report is not None:
+                report.add("gsettings", f"{schema_id} {key}",
+                           "ok" if code == 0 else "failed",
+                           time.perf_counter() - start, exit_code=code,
+                           via="exec")
+            if code == 0:
+                if store is not None:
+                    store.mark(f"gsettings:{schema_id}/{key}", digest(value))
+            else:
+                log.warning("`gsettings set %s %s %s` exited with %d: %s",
+                            schema_id, key, value, code, output.strip())
+
+
+class ProcessTable:
+    """The running processes, read from ``/proc`` once on first use.
+
+    The table may be used from several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes: Optional[list[tuple[int, str, str]]] = None
+
+    def processes(self) -> list[tuple[int, str, str]]:
+        """Returns the PID, name and command line of each process."""
+        with self._lock:
+            if self._processes is None:
+                self._processes = list(self._scan())
+            return self._processes
+
+    @staticmethod
+    def _scan():
+        own = os.getpid()
+        for entry in os.scandir("/proc"):
+            if not entry.name.isdigit() or int(entry.name) == own:
+                continue
+            try:
+                with open(os.path.join(entry.path, "comm"), "rb") as f:
+                    comm = f.read().rstrip(b"\n")
+                with open(os.path.join(entry.path, "cmdline"), "rb") as f:
+                    cmdline = f.read().rstrip(b"\0").replace(b"\0", b" ")
+            except OSError:
+                continue
+            yield (int(entry.name), comm.decode(errors="replace"),
+                   cmdline.decode(errors="replace"))
+
+
+def send_signal(action: SignalAction, table: ProcessTable) -> tuple[int, str]:
+    """Sends the signal of an action to the matching processes.
+
+    Returns:
+        0 and an empty string if every matching process was signalled (or had
+        exited meanwhile), and 1 and the errors otherwise.
+    """
+    errors = []
+    for pid, comm, cmdline in table.processes():
+        text = comm if action.process is not None else cmdline
+        if not action.pattern.search(text):
+            continue
+        try:
+            os.kill(pid, action.signum)
+        except ProcessLookupError:
+            pass
+        except OSError as e:
+            errors.append(f"{pid}: {e}")
+    return (1 if errors else 0), "\n".join(errors)
+
+
+def run_commands(commands: list[Action], max_workers: int,
+                 cancelled: Callable[[], bool] = never,
+                 store: Optional[StateStore] = None,
+                 report: Optional[SwitchReport] = None):
+    """Runs commands concurrently and logs the ones that fail.
+
+    Args:
+        commands: The commands to run.
+        max_workers: The maximum number of commands running at once.
+        cancelled: Returns whether the remaining commands should be skipped.
+        store: If given, commands that already succeeded in the unfinished
+            switch being resumed are skipped, and commands that succeed are
+            recorded.
+        report: If given, the outcome of each command is added to it.
+    """
+    table = ProcessTable()
+
+    def run(command: Action) -> Optional[tuple[int, str]]:
+        if cancelled():
+            return None
+        item = f"command:{command.name or command.label}"
+        item_hash = digest(command.label)
+        if store is not None and store.is_done(item, item_hash):
+            if report is not None:
+                report.add("commands", command.label, "skipped", 0.0)
+            return None
+        start = time.perf_counter()
+        if isinstance(command, SignalAction):
+            code, output = send_signal(command, table)
+            via = "builtin"
+        elif command.argv is None:
+            code, output = run_command(command.run)
+            via = "shell"
+        else:
+            code, output = run_command(command.argv)
+            via = "exec"
+        if report is not None:
+            report.add("commands", command.label,
+                       "ok" if code == 0 else "failed",
+                       time.perf_counter() - start, exit_code=code, via=via)
+        if store is not None and code == 0:
+            store.mark(item, item_hash)
+        return code, output
+
+    results = run_ordered(commands, run, max_workers)
+    for command, result in zip(commands, results):
+        if result is None:
+            continue
+        code, output = result
+        if code != 0:
+            log.warning("`%s` exited with %d: %s", command.label, code,
+                        output.strip())
+
+
+def extension_changes(config: Config, mode: theme) -> list[tuple[str, str]]:
+    """Returns the DConf keys and values to write for the given theme.
 
     Args:
         config: The loaded configuration.
         mode: The current theme mode ("light" or "dark").
+
+    Returns:
+        A list of ``(key, value)`` pairs, where ``value`` is in GVariant text
+        format, e.g. ``("/org/gnome/shell/extensions/blur-my-shell/panel/blur",
+        "true")``.
     """
+    changes = []
     for extension in config.extensions:
         for setting in extension.settings:
             if mode == theme.light:
@@ -252,58 +1715,913 @@ def apply_extension_settings(config: Config, mode: theme):
                 value = getattr(setting, "dark", None)
             if value is not None:
                 path = f"/org/gnome/shell/extensions/{extension.name}/{setting.path}"
-                command = f'dconf write {path} "{value}"'
-                run_command(command)
+                changes.append((path, value))
+    return changes
+
 
+def write_dconf(bus: dbus.Bus, changes: list[tuple[str, str]]):
+    r"""Writes DConf keys in a single change set over D-Bus.
 
-def toggle_theme(config: Config, namespace: str, key: str, value: int):
-    """Toggle theme based on system appearance changes.
+    The values are parsed the same way ``dconf write`` parses them and sent to
+    ``ca.desrt.dconf.Writer.Change`` as one serialized ``a{smv}`` change set,
+    so that all keys are written without spawning any process.
+
+    Args:
+        bus: The session bus.
+        changes: The ``(key, value)`` pairs to write.
+
+    Raises:
+        GLib.Error: If a value cannot be parsed.
+        dbus.DBusException: If the change set cannot be written.
+    """
+    import dbus
+    from gi.repository import GLib
+
+    changeset = GLib.Variant("a{smv}", {
+        key: GLib.Variant.parse(None, value, None, None)
+        for key, value in changes
+    })
+    writer = bus.get_object("ca.desrt.dconf", "/ca/desrt/dconf/Writer/user")
+    writer.Change(dbus.ByteArray(changeset.get_data_as_bytes().get_data()),
+                  dbus_interface="ca.desrt.dconf.Writer", signature="ay")
+
+
+def apply_dconf(changes: list[tuple[str, str]], bus: Optional[dbus.Bus] = None,
+                store: Optional[StateStore] = None,
+                report: Optional[SwitchReport] = None):
+    """Writes DConf keys.
+
+    If a session bus is given, all keys are written in-process with
+    :func:`write_dconf`. Otherwise, or if that fails, ``dconf write`` is
+    executed once per key.
+
+    Args:
+        changes: The ``(key, value)`` pairs to write.
+        bus: The session bus.
+        store: If given, keys that were already written for the target theme
+            are skipped, and keys that are written are recorded.
+        report: If given, the outcome of each key is added to it. Keys written
+            in one change set share its duration.
+    """
+    if store is not None:
+        skipped = [(path, value) for path, value in changes
+                   if store.is_done(f"dconf:{path}", digest(value))]
+        if report is not None:
+            for path, _ in skipped:
+                report.add("extensions", path, "skipped", 0.0)
+        changes = [change for change in changes if change not in skipped]
+    if not changes:
+        return
+    if bus is not None:
+        import dbus
+        from gi.repository import GLib
+
+        start = time.perf_counter()
+        try:
+            write_dconf(bus, changes)
+            seconds = time.perf_counter() - start
+            for path, value in changes:
+                if store is not None:
+                    store.mark(f"dconf:{path}", digest(value))
+                if report is not None:
+                    report.add("extensions", path, "ok", seconds,
+                               via="builtin")
+            return
+        except (GLib.Error, dbus.DBusException) as e:
+            log.warning("falling back to dconf write: %s", e)
+    dconf = shutil.which("dconf") or "dconf"
+    for path, value in changes:
+        start = time.perf_counter()
+        code, _ = run_command([dconf, "write", path, value])
+        if report is not None:
+            report.add("extensions", path, "ok" if code == 0 else "failed",
+                       time.perf_counter() - start, exit_code=code,
+                       via="exec")
+        if store is not None and code == 0:
+            store.mark(f"dconf:{path}", digest(value))
+
+
+def read_color_scheme(settings: dbus.proxies.ProxyObject) -> Optional[int]:
+    """Reads the current color scheme from the settings portal.
+
+    ``ReadOne`` is used if the portal supports it, and the deprecated ``Read``
+    otherwise.
+
+    Args:
+        settings: The proxy of the portal object.
+
+    Returns:
+        The value of the color scheme, or None if it cannot be read.
+    """
+    import dbus
+
+    for method in ("ReadOne", "Read"):
+        try:
+            return int(settings.get_dbus_method(method, SETTINGS_INTERFACE)(
+                APPEARANCE_NAMESPACE, COLOR_SCHEME_KEY))
+        except dbus.DBusException as e:
+            error = e
+    log.warning("cannot read the color scheme: %s", error)
+    return None
+
+
+def requested_theme(namespace: str, key: str, value: int) -> Optional[theme]:
+    """Returns the theme requested by a portal setting change, if any.
 
     Args:
-        config: The loaded configuration.
         namespace: The DBus namespace of the setting that changed.
         key: The specific setting key that changed.
         value: The new value (0 for light, 1 for dark).
     """
-    APPEARANCE_NAMESPACE = "org.freedesktop.appearance"
-    COLOR_SCHEME_KEY = "color-scheme"
+    if namespace != APPEARANCE_NAMESPACE or key != COLOR_SCHEME_KEY:
+        return None
+    return theme.light if value == 0 else theme.dark if value == 1 else None
+
+
+@dataclass(frozen=True)
+class Plan:
+    """Everything needed to apply a theme, derived once from a Config.
+
+    Attributes:
+        config: The configuration the plan was compiled from.
+        theme: The theme the plan applies.
+        files: The config files with their resolved paths.
+        commands: The commands to run.
+        dconf: The DConf keys and values to write.
+        gsettings: The GSettings schemas, keys and values to set.
+    """
+    config: Config
+    theme: theme
+    files: tuple[tuple[AppConfig, ResolvedPaths], ...]
+    commands: tuple[Action, ...]
+    dconf: tuple[tuple[str, str], ...]
+    gsettings: tuple[tuple[str, str, str], ...]
 
-    if namespace == APPEARANCE_NAMESPACE and key == COLOR_SCHEME_KEY:
-        mode: Optional[theme] = theme.light if value == 0 else theme.dark if value == 1 else None
+
+def compile_plan(config: Config, mode: theme) -> Plan:
+    """Compiles the plan for applying a theme.
+
+    Args:
+        config: The loaded configuration.
+        mode: The theme.
+
+    Returns:
+        The plan.
+
+    Raises:
+        ValueError: If a path of a config file uses a variable that is not
+            set.
+    """
+    if mode == theme.light:
+        commands = config.commands.dark_to_light
+    else:
+        commands = config.commands.light_to_dark
+    return Plan(
+        config=config,
+        theme=mode,
+        files=tuple((app, resolve_paths(app)) for app in config.config_files),
+        commands=tuple(commands),
+        dconf=tuple(extension_changes(config, mode)),
+        gsettings=tuple(gsettings_changes(config, mode)),
+    )
+
+
+def compile_plans(config: Config) -> dict[theme, Plan]:
+    """Compiles the plans for applying each theme."""
+    return {mode: compile_plan(config, mode) for mode in theme}
+
+
+def output_status(paths: ResolvedPaths) -> Optional[tuple]:
+    """Returns the status of the file a switch writes instead of the path.
+
+    That is the include file of a file with an ``include``, and the symlink
+    and the variant it points to for a file with a ``source``. It is None
+    if the file is missing or if the file is the path itself.
+    """
+    try:
+        if paths.include is not None:
+            st = os.stat(paths.include)
+            return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+        if paths.source is not None:
+            st = os.stat(paths.path)
+            return (os.readlink(paths.path), st.st_dev, st.st_ino, st.st_size,
+                    st.st_mtime_ns)
+    except OSError:
+        pass
+    return None
+
+
+def file_digest(config: Config, app: AppConfig, st: os.stat_result,
+                paths: ResolvedPaths) -> str:
+    """Returns the journal hash of a config file.
+
+    The hash covers the configuration of the file and its identity, size and
+    modification time, so any edit of either invalidates it without the file
+    having to be read. For files with an ``include`` or a ``source``, it also
+    covers the include or the symlink, so that they are repaired if they are
+    changed or removed.
+
+    Args:
+        config: The loaded configuration.
+        app: The config file.
+        st: The status of the file with the sections.
+        paths: The resolved paths of the config file.
+    """
+    return digest(config.delimiters, app, file_key(st, app.matcher),
+                  output_status(paths))
+
+
+def apply_plan(plan: Plan, bus: Optional[dbus.Bus] = None,
+               cancelled: Callable[[], bool] = never,
+               store: Optional[StateStore] = None) -> SwitchReport:
+    """Applies a theme to config files, GSettings, commands and extensions.
+
+    With a state store, config files whose configuration and status are
+    unchanged since they were switched to the theme are skipped. Commands,
+    GSettings keys and extension settings are only skipped if they were
+    applied by an interrupted switch to the same theme, which this one
+    resumes. The store is saved after each phase for that purpose.
+
+    Config files are switched concurrently, by up to ``config.file_workers``
+    threads, in the order given by their ``after`` entries. A file that cannot
+    be switched is logged and reported as ``failed``, and does not stop the
+    others.
+
+    Args:
+        plan: The compiled plan of the theme to apply.
+        bus: The session bus used to write extension settings.
+        cancelled: Returns whether the switch should be abandoned. It is
+            checked before each file and each command, and before the
+            GSettings keys and the extension settings.
+        store: The journal of applied items.
+
+    Returns:
+        The timings and outcomes of the switch.
+    """
+    report = SwitchReport(plan.theme)
+    start = time.perf_counter()
+    try:
+        report.completed = _apply_plan(plan, bus, cancelled, store, report)
+    finally:
+        report.seconds = time.perf_counter() - start
+    if report.completed:
+        log.info("switched to %s theme in %.3f s", plan.theme.name,
+                 report.seconds)
+    return report
+
+
+def _apply_plan(plan: Plan, bus: Optional[dbus.Bus],
+                cancelled: Callable[[], bool], store: Optional[StateStore],
+                report: SwitchReport) -> bool:
+    config, mode = plan.config, plan.theme
+    if store is not None:
+        store.begin(mode)
+
+    phase_start = time.perf_counter()
+    resolved = {id(config_file): paths for config_file, paths in plan.files}
+
+    def switch_file(config_file: AppConfig):
+        if cancelled():
+            return
+        paths = resolved[id(config_file)]
+        try:
+            st = os.stat(paths.tracked)
+        except FileNotFoundError:
+            return
+        item = f"file:{config_file.name}"
+        if store is not None and store.is_done(
+                item, file_digest(config, config_file, st, paths)):
+            log.info("%s: up to date", config_file.name)
+            report.add("files", config_file.name, "skipped", 0.0)
+            return
+        item_start = time.perf_counter()
+        try:
+            count, changed, size = modify_config_file(config, config_file,
+                                                      mode, paths)
+            # A switch does not write the source, and if it was edited
+            # meanwhile, the next switch has to rebuild the variants.
+            if paths.source is None:
+                st = os.stat(paths.tracked)
+        except (OSError, ValueError) as e:
+            log.error("%s: %s", config_file.name, e)
+            report.add("files", config_file.name, "failed",
+                       time.perf_counter() - item_start)
+            return
+        seconds = time.perf_counter() - item_start
+        log.info("%s: %s (%d sections)", config_file.name,
+                 "rewritten" if changed else "unchanged", count)
+        report.add("files", config_file.name,
+                   "rewritten" if changed else "unchanged", seconds,
+                   bytes=size)
+        if store is not None:
+            store.mark(item, file_digest(config, config_file, st, paths))
+
+    run_ordered([config_file for config_file, _ in plan.files], switch_file,
+                config.file_workers)
+    if store is not None:
+        store.save()
+    report.phases["files"] = time.perf_counter() - phase_start
+
+    if cancelled():
+        return False
+    phase_start = time.perf_counter()
+    apply_gsettings(list(plan.gsettings), store, report)
+    if store is not None:
+        store.save()
+    report.phases["gsettings"] = time.perf_counter() - phase_start
+
+    phase_start = time.perf_counter()
+    run_commands(list(plan.commands), config.commands.max_workers, cancelled,
+                 store, report)
+    if store is not None:
+        store.save()
+    report.phases["commands"] = time.perf_counter() - phase_start
+
+    if cancelled():
+        return False
+    phase_start = time.perf_counter()
+    apply_dconf(list(plan.dconf), bus, store, report)
+    report.phases["extensions"] = time.perf_counter() - phase_start
+
+    if store is not None:
+        store.finish(digest(plan))
+    return True
+
+
+def is_applied(plan: Plan, store: StateStore) -> bool:
+    """Returns whether the journal shows that a plan is in effect.
+
+    That is, the plan applied the theme last, and the config files are still
+    as it left them, by the same checks a switch skips them with.
+    """
+    if store.theme != plan.theme or store.plan != digest(plan):
+        return False
+    for config_file, paths in plan.files:
+        try:
+            st = os.stat(paths.tracked)
+        except FileNotFoundError:
+            continue
+        if not store.is_done(f"file:{config_file.name}",
+                             file_digest(plan.config, config_file, st, paths)):
+            return False
+    return True
+
+
+def apply_theme(config: Config, mode: theme, bus: Optional[dbus.Bus] = None,
+                cancelled: Callable[[], bool] = never,
+                store: Optional[StateStore] = None) -> SwitchReport:
+    """Applies a theme to config files, GSettings, commands and extensions.
+
+    See :func:`apply_plan` for the arguments.
+    """
+    return apply_plan(compile_plan(config, mode), bus, cancelled, store)
+
+
+PHASES = ("files", "gsettings", "commands", "extensions")
+
+
+def restrict_plan(plan: Plan, phases: list[str]) -> Plan:
+    """Returns a copy of the plan that only applies the given phases."""
+    return replace(
+        plan,
+        files=plan.files if "files" in phases else (),
+        gsettings=plan.gsettings if "gsettings" in phases else (),
+        commands=plan.commands if "commands" in phases else (),
+        dconf=plan.dconf if "extensions" in phases else (),
+    )
+
+
+def describe_plan(plan: Plan) -> list[str]:
+    """Describes what applying a plan would do, without doing it.
+
+    Args:
+        plan: The compiled plan.
+
+    Returns:
+        A unified diff of the config files that would change, followed by the
+        GSettings keys, the commands and the DConf keys, one per line.
+    """
+    lines = []
+    for config_file, paths in plan.files:
+        if os.path.exists(paths.tracked):
+            lines.extend(line if line.endswith("\n") else line + "\n"
+                         for line in diff_config_file(plan.config, config_file,
+                                                      plan.theme, paths))
+    for schema_id, key, value in plan.gsettings:
+        lines.append(f"gsettings set {schema_id} {key} {value}\n")
+    for command in plan.commands:
+        after = f"  # after {', '.join(command.after)}" if command.after else ""
+        lines.append(f"run: {command.label}{after}\n")
+    for path, value in plan.dconf:
+        lines.append(f"dconf write {path} {value}\n")
+    return lines
+
+
+def apply_once(config: Config, mode: theme, phases: list[str] = PHASES,
+               dry_run: bool = False) -> int:
+    """Applies a theme without a daemon, for ``theme-switcher apply``.
+
+    Extension settings are written with the ``dconf`` tool, so D-Bus is not
+    loaded. The state journal of the daemon is neither read nor written.
+
+    Args:
+        config: The loaded configuration.
+        mode: The theme.
+        phases: The phases to apply.
+        dry_run: Print what would be done instead of doing it.
+
+    Returns:
+        The exit status: 0 if everything was applied, 1 otherwise.
+    """
+    plan = restrict_plan(compile_plan(config, mode), phases)
+    if dry_run:
+        sys.stdout.writelines(describe_plan(plan))
+        return 0
+    report = apply_plan(plan)
+    for phase in PHASES:
+        if phase in phases and phase in report.phases:
+            log.info("%s: %.3f s", phase, report.phases[phase])
+    failed = any(item.status == "failed" for item in report.items)
+    return 0 if report.completed and not failed else 1
+
+
+def prometheus_label(value: str) -> str:
+    """Escapes a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+class Metrics:
+    r"""Exports switch reports.
+
+    Each report is logged as a single JSON line, and the last report together
+    with the number of switches so far is written to ``METRICS_FILE`` in the
+    Prometheus text format, for the node exporter's textfile collector.
+
+    Reports are exported by the switch thread and read from the main loop,
+    so the counts and the last report are only accessed under a lock.
+
+    Attributes:
+        path: The path of the metrics file, or None to not write one.
+        switches: Maps ``(theme, completed)`` to the number of switches.
+        last: The last report.
+    """
+    def __init__(self, path: Optional[str] = METRICS_FILE):
+        self.path = path
+        self.switches: dict[tuple[str, bool], int] = {}
+        self.last: Optional[SwitchReport] = None
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> tuple[dict[tuple[str, bool], int],
+                                Optional[SwitchReport]]:
+        """Returns a copy of the switch counts and the last report."""
+        with self._lock:
+            return dict(self.switches), self.last
+
+    def export(self, report: SwitchReport):
+        """Records, logs and writes a report."""
+        key = (report.theme.name, report.completed)
+        with self._lock:
+            self.switches[key] = self.switches.get(key, 0) + 1
+            self.last = report
+        log.info("%s", json.dumps(report.to_dict()))
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_file(self.path, self.to_prometheus())
+        except OSError as e:
+            log.warning("cannot write metrics: %s", e)
+
+    def to_dict(self) -> dict:
+        """Returns the switch counts and the last report as a dictionary."""
+        switches, last = self.snapshot()
+        return {
+            "switches": [{"theme": t, "completed": c, "count": n}
+                         for (t, c), n in sorted(switches.items())],
+            "last": None if last is None else last.to_dict(),
+        }
+
+    def to_prometheus(self) -> list[str]:
+        """Returns the lines of the metrics in the Prometheus text format."""
+        lines = []
+
+        def metric(name: str, kind: str, help: str,
+                   samples: list[tuple[dict[str, str], float]]):
+            lines.append(f"# HELP theme_switcher_{name} {help}\n")
+            lines.append(f"# TYPE theme_switcher_{name} {kind}\n")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{prometheus_label(str(v))}"'
+                                      for k, v in labels.items())
+                lines.append(f"theme_switcher_{name}{{{label_text}}} {value}\n")
+
+        switches, report = self.snapshot()
+        metric("switches_total", "counter", "Number of switches.",
+               [({"theme": t, "completed": str(c).lower()}, n)
+                for (t, c), n in sorted(switches.items())])
+        if report is None:
+            return lines
+        labels = {"theme": report.theme.name,
+                  "completed": str(report.completed).lower()}
+        metric("last_switch_timestamp_seconds", "gauge",
+               "When the last switch started.", [(labels, report.started)])
+        metric("last_switch_duration_seconds", "gauge",
+               "Duration of the last switch.", [(labels, report.seconds)])
+        metric("last_switch_phase_duration_seconds", "gauge",
+               "Duration of each phase of the last switch.",
+               [({"phase": phase}, seconds)
+                for phase, seconds in report.phases.items()])
+        metric("last_switch_item_duration_seconds", "gauge",
+               "Duration of each item of the last switch.",
+               [({"phase": i.phase, "item": i.item, "status": i.status},
+                 i.seconds) for i in report.items])
+        metric("last_switch_item_exit_code", "gauge",
+               "Exit code of each command of the last switch.",
+               [({"phase": i.phase, "item": i.item, "via": i.via or "shell"},
+                 i.exit_code)
+                for i in report.items if i.exit_code is not None])
+        metric("last_switch_item_bytes_written", "gauge",
+               "Bytes written for each config file in the last switch.",
+               [({"phase": i.phase, "item": i.item}, i.bytes)
+                for i in report.items if i.phase == "files"])
+        return lines
+
+
+class Daemon:
+    """Follows the system color scheme.
+
+    Changes are debounced: each one restarts a timer of
+    ``config.debounce_ms``, and only the theme requested last is handed to
+    the switch thread when it fires. Changes to the theme that is already
+    wanted are dropped.
+
+    Switches run on a single worker thread so that the main loop keeps
+    dispatching D-Bus messages. At most one switch runs at a time; if a
+    different theme is requested meanwhile, the running switch is abandoned
+    at the next file or command and the newer theme is applied instead.
+
+    What was applied is journaled in a :class:`StateStore` and restored on
+    start. The theme is re-applied if the configuration or a config file
+    changed in the meantime, and :meth:`sync` only switches if the theme
+    changed. Either way, only the items that are stale are redone.
+
+    ``CONFIG_FILE`` is watched, and the configuration is reloaded and
+    compiled into new plans whenever it changes. The plans are replaced as a
+    whole, and the current theme is then re-applied so that the edits take
+    effect. The ``source`` of each config file is watched as well, and the
+    current theme is re-applied when one changes, so that its variants are
+    rebuilt and the commands make the applications reload them.
+
+    Attributes:
+        config: The loaded configuration.
+        plans: The plans compiled from ``config``.
+        bus: The session bus.
+        store: The journal of applied items.
+        metrics: The exporter of switch reports.
+        applied: The theme applied completely last, if any.
+        wanted: The theme requested last, if any.
+        listeners: Called in the main loop with the report of each completed
+            switch.
+    """
+    def __init__(self, config: Config, bus: dbus.Bus):
+        from gi.repository import Gio
+
+        self.config = config
+        self.plans = compile_plans(config)
+        self.bus = bus
+        self.store = StateStore()
+        self.metrics = Metrics()
+        self.applied: Optional[theme] = self.store.theme
+        self.wanted: Optional[theme] = self.applied
+        if self.applied is not None and \
+                not is_applied(self.plans[self.applied], self.store):
+            self.applied = None
+        self.listeners: list[Callable[[SwitchReport], None]] = []
+        self._switching: Optional[theme] = None
+        # Counts reloads, so that a switch compiled from an older
+        # configuration is not taken as applied.
+        self._generation = 0
+        self._pending: Optional[theme] = None
+        self._timeout: Optional[int] = None
+        self._reload_timeout: Optional[int] = None
+        self._source_timeout: Optional[int] = None
+        self._monitor = Gio.File.new_for_path(CONFIG_FILE).monitor_file(
+            Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self._monitor.connect("changed", self._on_config_changed)
+        self._source_monitors = self._watch_sources(self.plans)
+        self._cond = threading.Condition()
+        self._cancel = threading.Event()
+        self._worker = threading.Thread(target=self._work, name="switch",
+                                        daemon=True)
+        self._worker.start()
+
+    def sync(self, settings: dbus.proxies.ProxyObject):
+        """Applies the current color scheme if it is not the applied one.
+
+        Args:
+            settings: The proxy of the settings portal object.
+        """
+        value = read_color_scheme(settings)
+        mode = None if value is None else \
+            requested_theme(APPEARANCE_NAMESPACE, COLOR_SCHEME_KEY, value)
+        if mode is not None:
+            self.request(mode)
+
+    def on_setting_changed(self, namespace: str, key: str, value: int):
+        """Handles the ``SettingChanged`` signal of the settings portal."""
+        mode = requested_theme(namespace, key, value)
         if mode is None:
             return
+        if self._timeout is None and mode == self.wanted:
+            return
+        from gi.repository import GLib
+
+        self._pending = mode
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+        self._timeout = GLib.timeout_add(self.config.debounce_ms, self._flush)
+
+    def _flush(self) -> bool:
+        from gi.repository import GLib
+
+        self._timeout = None
+        mode, self._pending = self._pending, None
+        if mode is not None:
+            self.request(mode)
+        return GLib.SOURCE_REMOVE
+
+    @staticmethod
+    def _written(event_type) -> bool:
+        from gi.repository import Gio
+
+        return event_type in (Gio.FileMonitorEventType.CHANGES_DONE_HINT,
+                              Gio.FileMonitorEventType.CREATED,
+                              Gio.FileMonitorEventType.MOVED_IN,
+                              Gio.FileMonitorEventType.RENAMED)
+
+    def _on_config_changed(self, monitor, file, other_file, event_type):
+        from gi.repository import GLib
+
+        if not self._written(event_type):
+            return
+        # Editors often write a file in several steps.
+        if self._reload_timeout is not None:
+            GLib.source_remove(self._reload_timeout)
+        self._reload_timeout = GLib.timeout_add(100, self._reload_later)
+
+    def _reload_later(self) -> bool:
+        from gi.repository import GLib
 
-        for config_file in config.config_files:
-            path = os.path.expandvars(config_file.path)
-            if not os.path.exists(path):
+        self._reload_timeout = None
+        self.reload()
+        return GLib.SOURCE_REMOVE
+
+    def _watch_sources(self, plans: dict[theme, Plan]) -> list:
+        from gi.repository import Gio
+
+        monitors = []
+        # The files are the same in the plans of both themes.
+        for _, paths in plans[theme.light].files:
+            if paths.source is None:
                 continue
-            modify_config_file(config, path, config_file.comment_token, mode)
+            monitor = Gio.File.new_for_path(paths.source).monitor_file(
+                Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect("changed", self._on_source_changed)
+            monitors.append(monitor)
+        return monitors
 
-        if mode == theme.light:
-            commands = config.commands.dark_to_light
-        else:
-            commands = config.commands.light_to_dark
-        
-        for command in commands:
-            run_command(command)
-        
-        apply_extension_settings(config, mode)
+    def _on_source_changed(self, monitor, file, other_file, event_type):
+        from gi.repository import GLib
 
+        if not self._written(event_type):
+            return
+        if self._source_timeout is not None:
+            GLib.source_remove(self._source_timeout)
+        self._source_timeout = GLib.timeout_add(100, self._reapply_later)
+
+    def _reapply_later(self) -> bool:
+        from gi.repository import GLib
+
+        self._source_timeout = None
+        log.info("a source changed, re-applying the theme")
+        # The journal skips the config files whose source did not change.
+        with self._cond:
+            self.applied = None
+            if self._switching is not None:
+                self._cancel.set()
+            self._cond.notify()
+        return GLib.SOURCE_REMOVE
+
+    def reload(self) -> bool:
+        """Reloads the configuration and re-applies the wanted theme.
 
-def main():
-    config = load_config()
+        Returns:
+            Whether the configuration was loaded. If it was not, the previous
+            configuration stays in effect.
+        """
+        try:
+            config = load_config()
+            plans = compile_plans(config)
+        except Exception as e:
+            log.error("cannot reload %s: %s", CONFIG_FILE, e)
+            return False
+        for monitor in self._source_monitors:
+            monitor.cancel()
+        self._source_monitors = self._watch_sources(plans)
+        with self._cond:
+            self.config, self.plans = config, plans
+            self._generation += 1
+            self.applied = None
+            if self._switching is not None:
+                self._cancel.set()
+            self._cond.notify()
+        log.info("reloaded %s", CONFIG_FILE)
+        return True
+
+    def request(self, mode: theme):
+        """Asks the switch thread to apply a theme."""
+        with self._cond:
+            self.wanted = mode
+            # Once set, the flag stays set until the switch ends: items may
+            # already have been skipped. If the switching theme is wanted
+            # again, it is switched to again, and the journal skips what the
+            # abandoned switch completed.
+            if self._switching is not None and self._switching != mode:
+                self._cancel.set()
+            self._cond.notify()
+
+    def state(self) -> dict[str, str]:
+        """Returns the applied, wanted and switching themes, or empty strings."""
+        with self._cond:
+            return {name: "" if mode is None else mode.name
+                    for name, mode in (("applied", self.applied),
+                                       ("wanted", self.wanted),
+                                       ("switching", self._switching))}
+
+    def _notify(self, report: SwitchReport) -> bool:
+        from gi.repository import GLib
+
+        for listener in self.listeners:
+            try:
+                listener(report)
+            except Exception:
+                log.exception("switch listener failed")
+        return GLib.SOURCE_REMOVE
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self.wanted is None or self.wanted == self.applied:
+                    self._cond.wait()
+                mode = self._switching = self.wanted
+                plan = self.plans[mode]
+                generation = self._generation
+                self._cancel.clear()
+            try:
+                report = apply_plan(plan, self.bus, self._cancel.is_set,
+                                    self.store)
+                self.metrics.export(report)
+                completed = report.completed
+                if completed:
+                    from gi.repository import GLib
+
+                    GLib.idle_add(self._notify, report)
+            except Exception:
+                log.exception("switching to %s theme failed", mode.name)
+                completed = False
+            with self._cond:
+                self._switching = None
+                # A partial switch leaves an unknown state behind, and a
+                # switch that a reload overtook did not apply the new plan.
+                stale = self._cancel.is_set() or \
+                    generation != self._generation
+                self.applied = mode if completed and not stale else None
+                if not completed and not self._cancel.is_set():
+                    # Do not retry a failed switch until asked again.
+                    self.wanted = None
+
+
+def export_daemon(daemon: Daemon, bus: dbus.Bus):
+    """Exports the control interface of a daemon on the session bus.
+
+    The object at ``DAEMON_OBJECT_PATH`` implements ``DAEMON_INTERFACE``:
+
+    - ``Apply(s theme)`` applies ``light`` or ``dark``.
+    - ``GetState() -> a{ss}`` returns the ``applied``, ``wanted`` and
+      ``switching`` themes, each empty if there is none.
+    - ``Reload() -> b`` reloads the configuration and re-applies the wanted
+      theme; it returns whether the configuration could be loaded.
+    - ``GetStats() -> s`` returns the switch counts and the last switch
+      report, as JSON.
+    - The ``ThemeApplied(s theme, d seconds)`` signal is emitted after each
+      completed switch.
+
+    Args:
+        daemon: The daemon to control.
+        bus: The session bus.
+
+    Returns:
+        The exported object.
+
+    Raises:
+        dbus.exceptions.NameExistsException: Another daemon owns
+            ``DAEMON_BUS_NAME``.
+    """
+    import dbus.service
+
+    class DaemonObject(dbus.service.Object):
+        def __init__(self):
+            self.bus_name = dbus.service.BusName(DAEMON_BUS_NAME, bus,
+                                                 do_not_queue=True)
+            super().__init__(self.bus_name, DAEMON_OBJECT_PATH)
+
+        @dbus.service.method(DAEMON_INTERFACE, in_signature="s")
+        def Apply(self, name: str):
+            try:
+                mode = theme[name]
+            except KeyError:
+                raise dbus.exceptions.DBusException(
+                    f"unknown theme {name!r}",
+                    name=f"{DAEMON_INTERFACE}.Error.InvalidArgs") from None
+            daemon.request(mode)
+
+        @dbus.service.method(DAEMON_INTERFACE, out_signature="a{ss}")
+        def GetState(self) -> dict[str, str]:
+            return daemon.state()
+
+        @dbus.service.method(DAEMON_INTERFACE, out_signature="b")
+        def Reload(self) -> bool:
+            return daemon.reload()
+
+        @dbus.service.method(DAEMON_INTERFACE, out_signature="s")
+        def GetStats(self) -> str:
+            return json.dumps(daemon.metrics.to_dict())
+
+        @dbus.service.signal(DAEMON_INTERFACE, signature="sd")
+        def ThemeApplied(self, name: str, seconds: float):
+            pass
+
+    service = DaemonObject()
+    daemon.listeners.append(
+        lambda report: service.ThemeApplied(report.theme.name, report.seconds))
+    return service
+
+
+def run_daemon(config: Config):
+    """Applies the theme of the desktop whenever it changes, until killed."""
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+    from gi.repository import GLib
+
+    threads_init()
     DBusGMainLoop(set_as_default=True)
     bus = dbus.SessionBus()
+    daemon = Daemon(config, bus)
+    try:
+        export_daemon(daemon, bus)
+    except dbus.exceptions.NameExistsException:
+        log.error("another theme-switcher is running")
+        sys.exit(1)
     settings = bus.get_object("org.freedesktop.portal.Desktop",
                               "/org/freedesktop/portal/desktop")
     settings.connect_to_signal(
         "SettingChanged",
-        lambda n, k, v: toggle_theme(config, n, k, v),
-        dbus_interface="org.freedesktop.portal.Settings"
+        daemon.on_setting_changed,
+        dbus_interface=SETTINGS_INTERFACE
     )
+    daemon.sync(settings)
     loop = GLib.MainLoop()
     loop.run()
 
 
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="theme-switcher",
+        description="Switch application themes with the desktop color "
+                    "scheme. Without a command, run as a daemon.")
+    subparsers = parser.add_subparsers(dest="command")
+    apply_parser = subparsers.add_parser(
+        "apply", help="apply a theme once and exit")
+    apply_parser.add_argument("theme", choices=[t.name for t in theme])
+    apply_parser.add_argument(
+        "--only", action="append", choices=PHASES, metavar="PHASE",
+        help=f"only apply this phase ({', '.join(PHASES)}); may be repeated")
+    apply_parser.add_argument(
+        "--dry-run", action="store_true",
+        help="print a diff of the config files and the settings and commands "
+             "instead of applying them")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    config = load_config()
+    if args.command == "apply":
+        sys.exit(apply_once(config, theme[args.theme], args.only or PHASES,
+                            args.dry_run))
+    run_daemon(config)
+
+
 if __name__ == "__main__":
     main()